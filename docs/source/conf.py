@@ -1,23 +1,60 @@
-# Recursive templating from StackOverflow
-# See https://stackoverflow.com/questions/2701998/automatically-document-all-modules-recursively-with-sphinx-autodoc/62613202#62613202
-
 # Configuration file for the Sphinx documentation builder.
 #
 # For the full list of built-in configuration values, see the documentation:
 # https://www.sphinx-doc.org/en/master/usage/configuration.html
 
-import importlib
-import inspect
+import ast
 import os
 import subprocess
 import sys
-from functools import reduce
+from functools import lru_cache
 from pathlib import Path
 
 ROOT = os.path.abspath("../../src")
 sys.path.insert(0, ROOT)
 
 
+def read_githash(git_dir: Path) -> str:
+    """Reads the current commit hash from a .git directory, or a .git file as used by worktrees and submodules"""
+    if git_dir.is_file():
+        # "gitdir: <path>", relative to the .git file
+        gitdir = git_dir.read_text().strip().removeprefix("gitdir: ")
+        git_dir = git_dir.parent / gitdir
+
+    head = (git_dir / "HEAD").read_text().strip()
+    if not head.startswith("ref: "):
+        return head
+
+    # Worktrees keep shared refs in a common directory
+    common_dir = git_dir
+    if (git_dir / "commondir").exists():
+        common_dir = git_dir / (git_dir / "commondir").read_text().strip()
+
+    # Loose refs first, then packed refs
+    ref = head[len("ref: ") :]
+    for ref_dir in (git_dir, common_dir):
+        ref_file = ref_dir / ref
+        if ref_file.exists():
+            return ref_file.read_text().strip()
+    for line in (common_dir / "packed-refs").read_text().splitlines():
+        if line.endswith(f" {ref}"):
+            return line.split()[0]
+    raise ValueError(f"Could not resolve git ref {ref}")
+
+
+@lru_cache(maxsize=None)
+def get_githash(git_dir: str = "../../.git") -> str:
+    """Reads the current commit hash without calling out to git, falling back to git if it can't be read"""
+    try:
+        return read_githash(Path(git_dir))
+    except (OSError, ValueError):
+        return (
+            subprocess.check_output(["git", "rev-parse", "HEAD"])
+            .strip()
+            .decode("ascii")
+        )
+
+
 # -- Project information -----------------------------------------------------
 # https://www.sphinx-doc.org/en/master/usage/configuration.html#project-information
 
@@ -25,14 +62,13 @@ project = "UA CMS Framework"
 copyright = "2025, Nathan A Nguyen"
 author = "Nathan A Nguyen"
 release = "0.0.1"
-githash = subprocess.check_output(["git", "rev-parse", "HEAD"]).strip().decode("ascii")
+githash = get_githash()
 
 # -- General configuration ---------------------------------------------------
 # https://www.sphinx-doc.org/en/master/usage/configuration.html#general-configuration
 
 extensions = [
-    "sphinx.ext.autodoc",
-    "sphinx.ext.autosummary",
+    "autoapi.extension",
     "sphinx.ext.graphviz",
     "sphinx.ext.intersphinx",
     "sphinx.ext.linkcode",
@@ -44,9 +80,11 @@ exclude_patterns = []
 
 ## CUSTOM
 
-autosummary_generate = True
-# autosummary_imported_members = True
-# autosummary_ignore_module_all = True
+# Parse sources statically rather than importing afw and its dependencies
+# Point at the package itself, or src would be documented as a namespace package (src.afw)
+autoapi_dirs = [os.path.join(ROOT, "afw")]
+autoapi_python_use_implicit_namespaces = True
+autoapi_add_toctree_entry = False
 
 napoleon_preprocess_types = True
 napoleon_type_aliases = {
@@ -60,25 +98,47 @@ napoleon_type_aliases = {
 }
 
 
-def linkcode_resolve(domain, info: dict):
-    if domain != "py":
+@lru_cache(maxsize=None)
+def parse_module(module: str) -> tuple[Path, ast.Module] | None:
+    """Parses a module's source once, without importing it"""
+    path = Path(ROOT, *module.split("."))
+    path = path / "__init__.py" if path.is_dir() else path.with_suffix(".py")
+    if not path.exists():
         return None
-    mod = importlib.import_module(info["module"])
-    try:
-        obj = reduce(getattr, [mod] + info["fullname"].split("."))
-    except AttributeError:
+    return path, ast.parse(path.read_text())
+
+
+@lru_cache(maxsize=None)
+def find_source(module: str, fullname: str) -> tuple[Path, int] | None:
+    """Finds the source file and line of an object by parsing its module, without importing it"""
+    parsed = parse_module(module)
+    if parsed is None:
         return None
-    try:
-        path = inspect.getsourcefile(obj)
-        if path is None:
+
+    path, node = parsed
+    for name in fullname.split("."):
+        for child in ast.iter_child_nodes(node):
+            if (
+                isinstance(child, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef))
+                and child.name == name
+            ):
+                node = child
+                break
+        else:
+            # skip attributes or other objects that aren't defined with def/class
             return None
-        relpath = Path(path).relative_to(ROOT)
-        _, lineno = inspect.getsourcelines(obj)
-    except TypeError:
-        # skip property or other type that inspect doesn't like
+
+    lineno = node.decorator_list[0].lineno if node.decorator_list else node.lineno
+    return path.relative_to(ROOT), lineno
+
+
+def linkcode_resolve(domain, info: dict):
+    if domain != "py":
         return None
-    except ValueError:
+    source = find_source(info["module"], info["fullname"])
+    if source is None:
         return None
+    relpath, lineno = source
     url = f"http://github.com/cmsua/4tops/blob/{githash}/{relpath}#L{lineno}"
     return url
 
@@ -1,23 +1,125 @@
-"""Command-line utility to merge skims using ``hadd``."""
+"""Command-line utility to merge skims using ``TFileMerger`` or ``hadd``."""
 
+import contextlib
 import logging
 import os
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+from dask.distributed import Client
+
+from ..dataset import skimmed
 from ..objects import AnalysisConfig
 from . import utils
 
+logger = logging.getLogger("Main")
+
 ## SOURCE: https://github.com/scikit-hep/coffea/discussions/1100
 
 
+def run_hadd(target: str, parts: list[str], jobs: int = 1) -> None:
+    """Run ``hadd`` on a set of files, keeping the compression of the inputs
+
+    Parameters:
+        target (str): The output file
+        parts (list[str]): The input files to merge
+        jobs (int, default 1): The number of processes ``hadd`` may use
+
+    Raises:
+        subprocess.CalledProcessError: If ``hadd`` fails
+    """
+    command = ["hadd", "-j", str(jobs), "-fk", target] + parts
+
+    logger.debug(f"Running command {command}")
+    out = subprocess.run(command)
+    if out.returncode != 0:
+        logger.critical(f"hadd returned with non-zero return code {out}")
+        out.check_returncode()
+
+
+def run_file_merger(target: str, parts: list[str]) -> None:
+    """Merge a set of files in-process using PyROOT's ``TFileMerger``, keeping the compression of the inputs
+
+    Parameters:
+        target (str): The output file
+        parts (list[str]): The input files to merge
+
+    Raises:
+        RuntimeError: If the files could not be merged
+    """
+    import ROOT
+
+    logger.debug(f"Merging {len(parts)} files into {target}")
+    merger = ROOT.TFileMerger(False, False)
+    merger.SetFastMethod(True)
+    merger.SetNotrees(False)
+    if not merger.OutputFile(target, "RECREATE"):
+        logger.critical(f"TFileMerger could not open output file {target}")
+        raise RuntimeError(f"Could not open output file {target}")
+
+    for part in parts:
+        merger.AddFile(part, False)
+
+    mode = (
+        ROOT.TFileMerger.kAll
+        | ROOT.TFileMerger.kIncremental
+        | ROOT.TFileMerger.kKeepCompression
+    )
+    if not merger.PartialMerge(mode):
+        logger.critical(f"TFileMerger failed to merge {target}")
+        raise RuntimeError(f"Failed to merge {target}")
+
+
+@contextlib.contextmanager
+def build_merged_dir(merged_dir: str):
+    """Create a temporary directory to merge into, which only replaces ``merged_dir`` once every merge has succeeded
+
+    Analysis code uses ``merged_dir`` for all datasets once it exists, so it must never be left incomplete.
+    The temporary directory is removed if merging fails.
+
+    Parameters:
+        merged_dir (str): The final merged directory, which must not exist yet
+
+    Yields:
+        str: The temporary directory to write merged files to
+    """
+    # The config's skim directory may not exist yet, eg. when merging on the first skim
+    parent_dir = os.path.dirname(merged_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=".merged-", dir=parent_dir)
+    # mkdtemp is private to the current user
+    os.chmod(build_dir, 0o755)
+    try:
+        yield build_dir
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    os.rename(build_dir, merged_dir)
+
+
 # Merge skims together
-def merge_skims(config: AnalysisConfig, skim_dir: str) -> None:
-    """Merge multi-part skims to one file using ``hadd``
+def merge_skims(
+    config: AnalysisConfig, skim_dir: str, jobs: int = None, client: Client = None
+) -> None:
+    """Merge multi-part skims to one file
+
+    If a Dask client is given, each fileset is merged with ``hadd`` on a worker, which must share the skim directory.
+    Otherwise, if PyROOT is available, filesets are merged in-process with ``TFileMerger``, using ``jobs`` threads.
+    Otherwise, filesets are merged concurrently, with each ``hadd`` using ``jobs`` processes.
 
     Parameters:
         config (objects.AnalysisConfig): The config to create skims for
         skim_dir (str): The output directory for skims
+        jobs (int, default os.cpu_count()): The number of processes each ``hadd`` may use
+        client (dask.distributed.Client, default None): A Dask client to merge filesets on
     """
+    cpus = os.cpu_count() or 1
+    if jobs is None:
+        jobs = cpus
+
     skim_dir_config = os.path.join(skim_dir, config.name)
 
     # List channels
@@ -29,53 +131,105 @@ def merge_skims(config: AnalysisConfig, skim_dir: str) -> None:
         logger.critical(f"Directory {merged_dir} exists, skipping...")
         return
 
-    # Make output dir
-    os.makedirs(merged_dir, exist_ok=True)
-
-    # Actually merge
+    # Find parts to merge
+    to_merge = []
     for fileset in dirs:
+        # Skip in-progress merges
+        if fileset.startswith("."):
+            continue
+
         # List dir, check for non-empty
         fileset_path = os.path.join(skim_dir_config, fileset)
-        parts = [part for part in os.listdir(fileset_path) if part.endswith(".root")]
+        parts = skimmed.list_parts(fileset_path)
         if len(parts) == 0:
             logger.warning(
                 f"Skipping dir {fileset} as it doesn't contain any root files!"
             )
             continue
 
-        # Make target file
-        target = os.path.join(merged_dir, f"{fileset}.root")
+        to_merge += [(fileset, [os.path.join(fileset_path, part) for part in parts])]
 
-        # Run hadd
-        command = ["hadd", target] + [
-            os.path.join(fileset_path, part) for part in sorted(parts)
+    # Actually merge
+    with build_merged_dir(merged_dir) as build_dir:
+        targets = [
+            os.path.join(build_dir, f"{fileset}.root") for fileset, _ in to_merge
         ]
 
-        logger.debug(f"Running command {command}")
-        out = subprocess.run(command)
-        if out.returncode != 0:
-            logger.critical(f"hadd returned with non-zero return code {out}")
+        # Run hadd on the cluster
+        if client is not None:
+            logger.info(f"Merging {len(to_merge)} filesets on Dask workers")
+            futures = client.map(
+                run_hadd,
+                targets,
+                [parts for _, parts in to_merge],
+                jobs=jobs,
+                pure=False,
+            )
+            client.gather(futures)
+            return
+
+        # Try merging in-process with PyROOT
+        try:
+            import ROOT
+        except ImportError:
+            logger.warning("PyROOT not found - merging with hadd")
+        else:
+            ROOT.EnableImplicitMT(jobs)
+            for target, (_, parts) in zip(targets, to_merge):
+                run_file_merger(target, parts)
+            return
+
+        # Run hadd, several filesets at a time
+        with ThreadPoolExecutor(max_workers=max(1, cpus // jobs)) as executor:
+            futures = [
+                executor.submit(run_hadd, target, parts, jobs)
+                for target, (_, parts) in zip(targets, to_merge)
+            ]
+            for future in futures:
+                future.result()
 
 
 if __name__ == "__main__":
     # Setup Args
     parser = utils.get_common_args()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes each hadd may use",
+    )
+    parser.add_argument(
+        "--dask",
+        action="store_true",
+        help="Merge filesets on the Dask cluster, which must share the skim directory",
+    )
     args = parser.parse_args()
 
     # Setup Logging
     utils.setup_logging(args.debug)
 
-    logger = logging.getLogger("Main")
     logger.info("Loaded program")
 
     # Create output dir
     skim_dir = os.path.expanduser(args.skim_dir)
     logger.info(f"Writing to skim dir {skim_dir}")
 
-    # Run on channel(s)
-    for config in utils.get_configs(args.config):
-        logger.info(f"Handling config {config}")
-        merge_skims(
-            config,
-            skim_dir,
-        )
+    # Get Dask Client
+    client = None
+    if args.dask:
+        client = utils.create_dask_client(args.cluster_address, [args.config])
+
+    try:
+        # Run on channel(s)
+        for config in utils.get_configs(args.config):
+            logger.info(f"Handling config {config}")
+            merge_skims(
+                config,
+                skim_dir,
+                args.jobs,
+                client,
+            )
+    finally:
+        if client is not None:
+            utils.close_dask_client(args.cluster_address)
@@ -10,6 +10,24 @@ from ..objects import ThingToPlot
 logger = logging.getLogger("Main")
 
 
+def plot_batch(
+    output_dir: str, extension: str, batch: list[tuple[ThingToPlot, object]]
+) -> None:
+    """
+    Save plots for a batch of histograms
+
+    Params:
+        output_dir (str): the directory to save plots to (including the config name)
+        extension (str): The file extension to use when saving plots
+        batch (list[tuple[ThingToPlot, object]]): Pairs of objects used to save plots and their histograms
+    """
+    for thing, histogram in batch:
+        thing.plot_histogram(
+            histogram,
+            os.path.join(output_dir, f"{thing.escaped_name}.{extension}"),
+        )
+
+
 def save_results(
     output_dir: str, extension: str, things: list[ThingToPlot], data: dict
 ) -> None:
@@ -22,26 +40,30 @@ def save_results(
         things (list[ThingToPlot]): All objects used to save plots
         data (dict): The object containing histograms
     """
+    pairs = [(thing, data[thing.title]) for thing in things]
+
     # Actually plot
-    # Try running with joblib
+    # Try running with loky (via joblib), which uses cloudpickle so things defined in config files can be sent to workers
     try:
-        import joblib
-
-        joblib.Parallel(n_jobs=-2)(
-            joblib.delayed(thing.plot_histogram)(
-                data[thing.title],
-                os.path.join(output_dir, f"{thing.escaped_name}.{extension}"),
-            )
-            for thing in things
-        )
+        from joblib.externals.loky import get_reusable_executor
     except ImportError:
         logger.warning("Joblib not found - plotting synchronously")
 
-        for thing in things:
-            thing.plot_histogram(
-                data[thing.title],
-                os.path.join(output_dir, f"{thing.escaped_name}.{extension}"),
-            )
+        plot_batch(output_dir, extension, pairs)
+        return
+
+    # Send several plots to each worker at once, keeping ~2 batches per worker
+    n_workers = max(1, (os.cpu_count() or 1) - 1)
+    batch_size = max(1, len(pairs) // (2 * n_workers))
+    batches = [pairs[i : i + batch_size] for i in range(0, len(pairs), batch_size)]
+
+    # Loky workers are spawned rather than forked, so live Dask client threads aren't copied
+    executor = get_reusable_executor(max_workers=n_workers)
+    futures = [
+        executor.submit(plot_batch, output_dir, extension, batch) for batch in batches
+    ]
+    for future in futures:
+        future.result()
 
 
 if __name__ == "__main__":
@@ -69,7 +91,9 @@ if __name__ == "__main__":
     # Run on channel(s)
     for config in utils.get_configs(args.config):
         output_dir = os.path.join(args.output_dir, config.name)
-        with open(os.path.join(output_dir, "results.pkl"), "rb") as file:
+        with open(
+            os.path.join(output_dir, "results.pkl"), "rb", buffering=1 << 20
+        ) as file:
             results = pickle.load(file)
 
         save_results(output_dir, args.extension, config.get_things_to_plot(), results)
@@ -72,8 +72,8 @@ def handle_channel(
     os.makedirs(output_dir, exist_ok=True)
 
     logger.info("Saving hists")
-    with open(os.path.join(output_dir, "results.pkl"), "wb") as file:
-        pickle.dump(results, file)
+    with open(os.path.join(output_dir, "results.pkl"), "wb", buffering=1 << 20) as file:
+        pickle.dump(results, file, protocol=pickle.HIGHEST_PROTOCOL)
 
     plotter.save_results(output_dir, "png", config.get_things_to_plot(), results)
 
@@ -126,4 +126,4 @@ if __name__ == "__main__":
                 runner,
             )
     finally:
-        client.close()
+        utils.close_dask_client(args.cluster_address)
@@ -1,10 +1,31 @@
+import itertools
 import logging
 
 import yaml
 
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
 from .. import dataset
 from . import utils
 
+
+def write_lines(path: str, lines: list[str]) -> None:
+    """
+    Write one line per entry to a file, in a single call
+
+    Parameters:
+        path (str): The file to write to
+        lines (list[str]): The lines to write, without newlines
+    """
+    with open(path, "w") as file:
+        if lines:
+            file.write("\n".join(lines))
+            file.write("\n")
+
+
 if __name__ == "__main__":
     # Setup Args
     parser = utils.get_common_args()
@@ -56,25 +77,26 @@ if __name__ == "__main__":
     dataset.print_summary(my_fileset, logger)
 
     files = [list(it["files"].keys()) for it in my_fileset.values()]
-    files_all = sum(files, [])
+    files_all = list(itertools.chain.from_iterable(files))
 
     # Save Files
-    with open(args.output_file, "w") as file:
-        file.writelines([f"{line}\n" for line in files_all])
+    write_lines(args.output_file, files_all)
 
     # Save Files Sorted
-    files_ord = []
-    for i in range(max([len(it) for it in files])):
-        for file_list in files:
-            if i >= len(file_list):
-                continue
-            files_ord += [file_list[i]]
-    with open(args.output_file_sorted, "w") as file:
-        file.writelines([f"{line}\n" for line in files_ord])
-
-    # Delete keys for preview
-    for key in my_fileset:
-        del my_fileset[key]["files"]
+    # Interleave datasets, taking one file from each in turn
+    files_ord = [
+        file
+        for row in itertools.zip_longest(*files)
+        for file in row
+        if file is not None
+    ]
+    write_lines(args.output_file_sorted, files_ord)
+
+    # Drop files for preview, without modifying the fileset
+    preview = {
+        key: {k: v for k, v in val.items() if k != "files"}
+        for key, val in my_fileset.items()
+    }
     # Debug
     with open(args.output_file_full, "w") as file:
-        yaml.dump(my_fileset, file)
+        yaml.dump(preview, file, Dumper=SafeDumper)
@@ -1,7 +1,9 @@
 """Command-line utility to create skims for a given :class:`objects.AnalysisConfig`."""
 
+import contextlib
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import awkward as ak
 import dask
@@ -11,22 +13,21 @@ from coffea.dataset_tools import apply_to_fileset, preprocess
 from coffea.nanoevents import NanoAODSchema
 
 from ..objects import AnalysisConfig
-from . import utils
+from . import merge_skims, utils
 from ..dataset import print_summary, skimmed
 
 ## SOURCE: https://github.com/scikit-hep/coffea/discussions/1100
 
 
-def is_rootcompat(a: ak.Array) -> bool:
-    """Returns whether an array can be written to a Root file
+def is_rootcompat_type(t: ak.types.Type) -> bool:
+    """Returns whether an array of a given type can be written to a Root file
 
     Parameters:
-        a (ak.Array): Any Awkward Array
+        t (ak.types.Type): The type of any Awkward Array
 
     returns:
-        bool: Whether the parameter is a flat or 1d jagged array
+        bool: Whether the type is a flat or 1d jagged array
     """
-    t = dak.type(a)
     if isinstance(t, ak.types.NumpyType):
         return True
     if isinstance(t, ak.types.ListType) and isinstance(t.content, ak.types.NumpyType):
@@ -35,6 +36,60 @@ def is_rootcompat(a: ak.Array) -> bool:
     return False
 
 
+def is_rootcompat(a: ak.Array) -> bool:
+    """Returns whether an array can be written to a Root file
+
+    Parameters:
+        a (ak.Array): Any Awkward Array
+
+    returns:
+        bool: Whether the parameter is a flat or 1d jagged array
+    """
+    return is_rootcompat_type(dak.type(a))
+
+
+def rootcompat_fields(events: ak.Array) -> tuple[list[str], dict[str, list[str]]]:
+    """Walks the type of an array once to find all columns that can be written to a Root file
+
+    Parameters:
+        events (ak.Array): Any given Awkward Array of records
+
+    Returns:
+        tuple[list[str], dict[str, list[str]]]: The names of all flat fields, and a map from the name of each collection to its compatible subfields
+    """
+    flat_names = []
+    collections = {}
+    record_type = events.form.type
+    for bname, btype in zip(record_type.fields, record_type.contents):
+        # Look through one level of lists, as in jagged collections
+        outer = None
+        if isinstance(btype, (ak.types.ListType, ak.types.RegularType)) and isinstance(
+            btype.content, ak.types.RecordType
+        ):
+            outer, btype = btype, btype.content
+
+        if not isinstance(btype, ak.types.RecordType):
+            flat_names += [bname]
+            continue
+
+        # Subfields of jagged collections are themselves jagged
+        if outer is None:
+            subtypes = btype.contents
+        elif isinstance(outer, ak.types.ListType):
+            subtypes = [ak.types.ListType(subtype) for subtype in btype.contents]
+        else:
+            # Subfields of regular collections cannot be written
+            subtypes = []
+
+        collections[bname] = [
+            n
+            for n, subtype in zip(btype.fields, subtypes)
+            if is_rootcompat_type(subtype)
+        ]
+
+    return flat_names, collections
+
+
 def uproot_writeable(events: ak.Array) -> ak.Array:
     """Restrict to columns that uproot can write compactly
 
@@ -44,16 +99,15 @@ def uproot_writeable(events: ak.Array) -> ak.Array:
     Returns:
         ak.Array: An Awkward Array without any incompatible fields
     """
-    out_event = events[list(x for x in events.fields if not events[x].fields)]
-    for bname in events.fields:
-        if events[bname].fields:
-            out_event[bname] = ak.zip(
-                {
-                    n: ak.without_parameters(events[bname][n])
-                    for n in events[bname].fields
-                    if is_rootcompat(events[bname][n])
-                }
-            )
+    flat_names, collections = rootcompat_fields(events)
+
+    out_event = events[flat_names]
+    for bname, subfields in collections.items():
+        if not subfields:
+            continue
+
+        # Project the collection directly rather than re-zipping each subfield, as they already share a layout
+        out_event[bname] = ak.without_parameters(events[bname][subfields])
     return out_event
 
 
@@ -63,6 +117,8 @@ def handle_config(
     skim_dir: str,
     run_combined: bool = False,
     skip_bad_files: bool = False,
+    partitions_per_file: int = 15,
+    merge: bool = False,
 ) -> None:
     """Create and save skims for a given :class:`objects.AnalysisConfig`
 
@@ -70,8 +126,10 @@ def handle_config(
         config (objects.AnalysisConfig): The config to create skims for
         xrd_redirector (str): The host of the XRootD Redirector to use
         skim_dir (str): The output directory for skims
-        run_combined (bool, default False): Whether to submit preprocessing and skimming to the Dask Client as one compute or to run each dataset in series
+        run_combined (bool, default False): Whether to submit skimming to the Dask Client as one compute or to write each dataset in series
         skip_bad_files (bool, default False): Whether or not to skip bad files in the dataset
+        partitions_per_file (int, default 15): The number of input partitions to combine into each output file
+        merge (bool, default False): Whether to merge each dataset with ``hadd`` once it has been written, while later datasets are skimmed. Datasets skimmed by earlier runs are merged too
     """
     # Load dataset, with preskims if needed
     my_dataset = config.get_dataset(xrd_redirector)
@@ -89,10 +147,9 @@ def handle_config(
             continue
 
         # Check for root files - if there are none, we can run on this dataset
-        root_files = [
-            file for file in os.listdir(dataset_dir) if file.endswith(".root")
-        ]
-        if len(root_files) == 0:
+        with os.scandir(dataset_dir) as entries:
+            has_root = any(entry.name.endswith(".root") for entry in entries)
+        if not has_root:
             logger.warning(f"Empty output directory, continuing: {dataset_dir}")
         else:
             logger.critical(
@@ -117,54 +174,101 @@ def handle_config(
         "save_form": False,
     }
 
-    # Preprocess in bulk if needed
-    if run_combined:
-        logger.info("Preprocessing filesets")
-        dataset_runnable, _ = preprocess(my_dataset, **preprocess_params)
-
-        logger.info("Computing Task Graph")
-        skimmed_dict = apply_to_fileset(
-            skim, dataset_runnable, schemaclass=NanoAODSchema
-        )
+    # Preprocess and build the task graph once for all filesets
+    logger.info("Preprocessing filesets")
+    dataset_runnable, _ = preprocess(my_dataset, **preprocess_params)
+
+    logger.info("Computing Task Graph")
+    skimmed_dict = apply_to_fileset(skim, dataset_runnable, schemaclass=NanoAODSchema)
+
+    config_dir = os.path.join(skim_dir, config.name)
+    merged_dir = os.path.join(config_dir, "merged")
+    if merge and os.path.exists(merged_dir):
+        logger.critical(f"Directory {merged_dir} exists, skipping merge...")
+        merge = False
+
+    with contextlib.ExitStack() as stack:
+        # Merge filesets in the background while later filesets are still being skimmed
+        # Merges are written to a temporary directory, which only becomes merged_dir once every fileset is merged
+        merger = None
+        merges = {}
+        if merge:
+            build_dir = stack.enter_context(merge_skims.build_merged_dir(merged_dir))
+            merger = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+
+        def finish(destination: str) -> None:
+            parts = skimmed.write_manifest(destination)
+            if merger is None or len(parts) == 0:
+                return
+
+            name = os.path.basename(destination)
+            merges[name] = merger.submit(
+                merge_skims.run_hadd,
+                os.path.join(build_dir, f"{name}.root"),
+                [os.path.join(destination, part) for part in parts],
+                os.cpu_count() or 1,
+            )
 
-    # Run
-    to_run = []
-    for fileset_name, fileset in my_dataset.items():
-        logger.info(f"Handling fileset {fileset_name}")
-        if not run_combined:
-            logger.debug(f"Preprocessing fileset {fileset_name}")
-            dataset_runnable, _ = preprocess(
-                {fileset_name: fileset}, **preprocess_params
+        # Run
+        to_run = []
+        destinations = []
+        for fileset_name, skimmed_events in skimmed_dict.items():
+            logger.info(f"Handling fileset {fileset_name}")
+            skimmed_writable = uproot_writeable(skimmed_events)
+            # Reparititioning so that output files aren't too small
+            # Selection makes divisions unknown, so partitions are combined rather than split by event count
+            skimmed_writable = skimmed_writable.repartition(
+                n_to_one=partitions_per_file
             )
 
-            logger.debug(f"Computing Task Graph for {fileset_name}")
-            skimmed_dict = apply_to_fileset(
-                skim, dataset_runnable, schemaclass=NanoAODSchema
+            # Output directory
+            destination = os.path.join(config_dir, skimmed.escape_name(fileset_name))
+
+            # Return so that compute can be called
+            logger.debug("Writing...")
+            result = uproot.dask_write(
+                skimmed_writable,
+                compute=not run_combined,
+                tree_name="Events",
+                destination=destination,
             )
 
-        skimmed_writable = uproot_writeable(skimmed_dict[fileset_name])
-        skimmed_writable = skimmed_writable.repartition(
-            n_to_one=15,
-        )  # Reparititioning so that output file contains ~100_000 eventspartition
+            if run_combined:
+                destinations += [destination]
+            else:
+                finish(destination)
 
-        # Output directory
-        destination = os.path.join(
-            skim_dir, config.name, skimmed.escape_name(fileset_name)
-        )
+            to_run += [result]
+        if run_combined:
+            logger.info("Computing all...")
+            dask.compute(*to_run)
 
-        # Return so that compute can be called
-        logger.debug("Writing...")
-        result = uproot.dask_write(
-            skimmed_writable,
-            compute=not run_combined,
-            tree_name="Events",
-            destination=destination,
-        )
+            for destination in destinations:
+                finish(destination)
+
+        if merger is not None:
+            # Also merge filesets skimmed by earlier runs, so the merged directory is complete
+            for name in os.listdir(config_dir):
+                path = os.path.join(config_dir, name)
+                # Skip filesets already merged, and in-progress merges
+                if name in merges or name.startswith(".") or not os.path.isdir(path):
+                    continue
+
+                parts = skimmed.list_parts(path)
+                if len(parts) == 0:
+                    continue
+
+                merges[name] = merger.submit(
+                    merge_skims.run_hadd,
+                    os.path.join(build_dir, f"{name}.root"),
+                    [os.path.join(path, part) for part in parts],
+                    os.cpu_count() or 1,
+                )
 
-        to_run += [result]
-    if run_combined:
-        logger.info("Computing all...")
-        dask.compute(*to_run)
+            # Any failed merge raises, so the merged directory is never left incomplete
+            logger.info("Waiting for merges to finish...")
+            for future in merges.values():
+                future.result()
 
 
 if __name__ == "__main__":
@@ -176,6 +280,19 @@ if __name__ == "__main__":
         action="store_true",
         help="Compute each dataset in parallel rather than in series",
     )
+    parser.add_argument(
+        "-m",
+        "--merge",
+        action="store_true",
+        help="Merge skims once they have been written",
+    )
+    parser.add_argument(
+        "-n",
+        "--partitions-per-file",
+        type=int,
+        default=15,
+        help="Number of input partitions to combine into each skim file",
+    )
     args = parser.parse_args()
 
     # Setup Logging
@@ -201,7 +318,9 @@ if __name__ == "__main__":
                 skim_dir,
                 args.parallel,
                 skip_bad_files=not args.debug,
+                partitions_per_file=args.partitions_per_file,
+                merge=args.merge,
             )
 
     finally:
-        client.close()
+        utils.close_dask_client(args.cluster_address)
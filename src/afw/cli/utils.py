@@ -3,20 +3,72 @@ Utilities for CLI tools
 """
 
 import argparse
+import functools
 import importlib.util
+import io
 import logging
 import os
 import sys
+import tempfile
+import threading
 import inspect
-from dask.distributed import Client
+import zipfile
+import dask
+from dask.distributed import Client, get_client, get_worker
 
 from ..objects import AnalysisConfig
 
 logger = logging.getLogger("utils")
 
 
+# Name of the zipped bundle of uploaded files on each worker
+bundle_name = "afw-upload.zip"
+
+
+def bundle_files(upload_files: list[str]) -> bytes:
+    """
+    Packs local python files into a single in-memory zip archive
+
+    Parameters:
+        upload_files (list[str]): Local python files to bundle
+
+    Returns:
+        bytes: The zip archive, with each file stored under its base name
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+        for path in upload_files:
+            logger.debug(f"Bundling file {path}")
+            bundle.write(path, os.path.basename(path))
+    return buffer.getvalue()
+
+
+def upload_worker_files(client: Client, upload_files: list[str]) -> None:
+    """
+    Uploads local python files to all Dask workers at once, as a single zipped bundle
+
+    Parameters:
+        client (dask.distributed.Client): The Dask client to upload files with
+        upload_files (list[str]): Local python files to upload
+    """
+    bundle = bundle_files(upload_files)
+
+    # upload_file broadcasts once (including to workers that join later), adds zip files to sys.path and reloads their modules,
+    # so edited configs replace those already imported by warm workers
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, bundle_name)
+        with open(path, "wb") as file:
+            file.write(bundle)
+        client.upload_file(path)
+
+
 # Dask Cluster Util
-# Returns Client, Cluster
+# Clients are reused per cluster address, and spawned local clusters are kept to be closed alongside their client
+dask_clients: dict[str, Client] = {}
+dask_clusters: dict[str, object] = {}
+dask_lock = threading.Lock()
+
+
 def create_dask_client(cluster_address: str, upload_files: list[str] = []):
     """
     Creates a Dask client and optionally uploads required Python code.
@@ -28,6 +80,12 @@ def create_dask_client(cluster_address: str, upload_files: list[str] = []):
 
     The following files will be uploaded if set: configs/\*.py, processor.py
 
+    If a running client already exists for the given address, it is returned instead of creating a new one.
+
+    Connections time out after 60 seconds, which may be overridden with the AFW_DASK_CONNECT_TIMEOUT environment variable.
+
+    When called from within a Dask task, the worker's own client is returned and nothing is created or uploaded.
+
     Parameters:
         cluster_address(str): One of the above supported clients
         upload_files (list[str], default []):  Local python files to upload to the Dask client
@@ -35,53 +93,104 @@ def create_dask_client(cluster_address: str, upload_files: list[str] = []):
     Returns:
         dask.distributed.Client: A Dask client
     """
-    logger.info("Loading Dask client")
-    if cluster_address == "local":
-        upload = False
+    # Don't spawn nested clusters or extra scheduler connections from inside a task
+    try:
+        get_worker()
+    except ValueError:
+        pass
+    else:
+        logger.debug("Running on a Dask worker, using the worker client")
+        return get_client()
 
-        from dask.distributed import LocalCluster
+    with dask_lock:
+        client = dask_clients.get(cluster_address)
+        if client is not None and client.status == "running":
+            logger.debug(f"Reusing Dask client for {cluster_address}")
+            return client
 
-        cluster = LocalCluster()
-        client = cluster.get_client()
-    elif cluster_address == "gateway":
-        upload = False
+        logger.info("Loading Dask client")
 
-        logger.debug("Connecting to gateway")
-        from dask_gateway import Gateway
+        # The default connect timeout (10s) fails spuriously on busy or large clusters
+        timeout = int(os.environ.get("AFW_DASK_CONNECT_TIMEOUT", 60))
+        dask.config.set(
+            {
+                "distributed.comm.timeouts.connect": f"{timeout}s",
+                "distributed.comm.timeouts.tcp": f"{timeout}s",
+            }
+        )
 
-        gateway = Gateway()
-        clusters = gateway.list_clusters()
-        if len(clusters) == 0:
-            raise ValueError("No cluster exists in the gateway!")
+        if cluster_address == "local":
+            upload = False
 
-        logger.debug("Fetching cluster {cluters[0].name}")
-        cluster = gateway.connect(clusters[0].name)
-        client = Client(cluster, timeout=60)
-    else:
-        upload = True
+            from dask.distributed import LocalCluster
 
-        logger.debug(f"Connecting to cluster at {cluster_address}")
-        client = Client(cluster_address)
+            cluster = LocalCluster()
+            client = cluster.get_client()
+            dask_clusters[cluster_address] = cluster
+        elif cluster_address == "gateway":
+            upload = False
 
-    if upload:
-        # Upload Files
-        logger.debug("Uploading files to workers...")
-        for file in upload_files:
-            logger.debug(f"Uploading file {file}")
-            client.upload_file(file)
+            logger.debug("Connecting to gateway")
+            from dask_gateway import Gateway
 
-    else:
-        logger.warning("Skipping upload files to workers")
+            gateway = Gateway()
+            clusters = gateway.list_clusters()
+            if len(clusters) == 0:
+                raise ValueError("No cluster exists in the gateway!")
+
+            logger.debug("Fetching cluster {cluters[0].name}")
+            cluster = gateway.connect(clusters[0].name)
+            client = Client(cluster, timeout=timeout)
+        else:
+            upload = True
+
+            logger.debug(f"Connecting to cluster at {cluster_address}")
+            client = Client(cluster_address, timeout=timeout)
+
+        if upload:
+            # Upload Files
+            logger.debug("Uploading files to workers...")
+            upload_worker_files(client, upload_files)
+
+        else:
+            logger.warning("Skipping upload files to workers")
+
+        logger.info(f"Dashboard located at {client.dashboard_link}")
+        dask_clients[cluster_address] = client
+        return client
 
-    logger.info(f"Dashboard located at {client.dashboard_link}")
-    return client
+
+def close_dask_client(cluster_address: str = None) -> None:
+    """
+    Closes a Dask client created by :func:`create_dask_client`, as well as any local cluster it spawned
+
+    Parameters:
+        cluster_address (str, default None): The address the client was created with. If None, all clients are closed.
+    """
+    with dask_lock:
+        if cluster_address is None:
+            addresses = list(dask_clients.keys())
+        else:
+            addresses = [cluster_address]
+
+        for address in addresses:
+            client = dask_clients.pop(address, None)
+            if client is not None:
+                client.close()
+
+            cluster = dask_clusters.pop(address, None)
+            if cluster is not None:
+                cluster.close()
 
 
 # Root Host
+@functools.lru_cache(maxsize=1)
 def get_xrd_redirector():
     """
     Returns an xcache redirector. Defaults to the CMS Global Redirector if XCache cannot be detected.
 
+    The result is cached - call ``get_xrd_redirector.cache_clear()`` after changing XCACHE_HOST.
+
     Returns:
         str: The local XCache redirector, or the CMS Global Redirector if not present
     """
@@ -91,6 +200,9 @@ def get_xrd_redirector():
 
 
 # Common Args
+env_path = os.path.join(os.getcwd(), ".env")
+
+
 def get_common_args():
     """
     Load common arguments for CLI programs. Currently supports:
@@ -99,9 +211,13 @@ def get_common_args():
     - fileset root for non-skimmed files
     - debug mode
     """
-    import dotenv
+    # Only pay for the dotenv import when there is something to load
+    if os.path.exists(env_path):
+        import dotenv
 
-    dotenv.load_dotenv()
+        # XCACHE_HOST may have been set by the .env file
+        if dotenv.load_dotenv(env_path):
+            get_xrd_redirector.cache_clear()
 
     # Setup Args
     parser = argparse.ArgumentParser("Analysis FrameWork (UA)")
@@ -140,16 +256,17 @@ def get_common_args():
     return parser
 
 
-# Get config from ee, emu, mumu, or common (common is only used for skimming)
-def get_configs(file_path: str) -> list[AnalysisConfig]:
+@functools.lru_cache(maxsize=None)
+def load_config_module(file_path: str, mtime: float):
     """
-    Returns an analysis config from a given name. The file will be imported as the given module name.
+    Imports a config module once per path and modification time
 
     Parameters:
-        file_path (str): The path to a python module
+        file_path (str): The absolute path to a python module
+        mtime (float): The modification time of the module, used to reload it when changed
 
     Returns:
-        list[objects.AnalysisConfig]: All AnalysisConfigs in said module
+        module: The imported module
     """
     # Code taken form importlib docs
     module_name = os.path.basename(file_path).replace(".py", "")
@@ -157,10 +274,26 @@ def get_configs(file_path: str) -> list[AnalysisConfig]:
     module = importlib.util.module_from_spec(spec)
     sys.modules[module_name] = module
     spec.loader.exec_module(module)
+    return module
+
+
+# Get config from ee, emu, mumu, or common (common is only used for skimming)
+def get_configs(file_path: str) -> list[AnalysisConfig]:
+    """
+    Returns an analysis config from a given name. The file will be imported as the given module name.
+
+    Parameters:
+        file_path (str): The path to a python module
+
+    Returns:
+        list[objects.AnalysisConfig]: All AnalysisConfigs in said module
+    """
+    file_path = os.path.abspath(file_path)
+    module = load_config_module(file_path, os.path.getmtime(file_path))
 
     # Inspect module
     return [cls() for cls in module.__all__]
-    
+
 
 # LOGGING
 class Formatter(logging.Formatter):
@@ -175,16 +308,39 @@ class Formatter(logging.Formatter):
     reset = "\x1b[0m"
     format = "%(asctime)s - %(name)-10s - %(levelname)-7s - %(message)s (%(filename)s:%(lineno)d)"
 
-    FORMATS = {
-        logging.DEBUG: logging.Formatter(grey + format + reset),
-        logging.INFO: logging.Formatter(format),
-        logging.WARNING: logging.Formatter(yellow + format + reset),
-        logging.ERROR: logging.Formatter(red + format + reset),
-        logging.CRITICAL: logging.Formatter(bold_red + format + reset),
-    }
+    # Only color output when writing to a terminal, see https://no-color.org
+    use_color = sys.stderr.isatty() and os.environ.get("NO_COLOR") is None
+
+    if use_color:
+        FORMATS = {
+            logging.DEBUG: logging.Formatter(grey + format + reset),
+            logging.INFO: logging.Formatter(format),
+            logging.WARNING: logging.Formatter(yellow + format + reset),
+            logging.ERROR: logging.Formatter(red + format + reset),
+            logging.CRITICAL: logging.Formatter(bold_red + format + reset),
+        }
+    else:
+        plain = logging.Formatter(format)
+        FORMATS = {
+            logging.DEBUG: plain,
+            logging.INFO: plain,
+            logging.WARNING: plain,
+            logging.ERROR: plain,
+            logging.CRITICAL: plain,
+        }
+
+    # Indexed by levelno // 10, clamped so custom levels use the nearest formatter
+    FORMATS_BY_LEVEL = [
+        FORMATS[logging.DEBUG],
+        FORMATS[logging.DEBUG],
+        FORMATS[logging.INFO],
+        FORMATS[logging.WARNING],
+        FORMATS[logging.ERROR],
+        FORMATS[logging.CRITICAL],
+    ]
 
     def format(self, record):
-        return self.FORMATS.get(record.levelno).format(record)
+        return self.FORMATS_BY_LEVEL[min(record.levelno // 10, 5)].format(record)
 
 
 def setup_logging(debug: bool = False):
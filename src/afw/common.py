@@ -3,14 +3,33 @@ A utility module containing commonly-plotted things
 """
 
 import abc
+
 import awkward as ak
 import hist
 import mplhep as hep
+import numba
 import numpy as np
 
 from .objects import ThingToPlot
 
 
+# Colors consistent with the CMS Analysis Guidelines (https://cms-analysis.docs.cern.ch/guidelines/plotting/colors/)
+STACKED_COLORS = (
+    "#3f90da",
+    "#ffa90e",
+    "#bd1f01",
+    "#94a4a2",
+    "#832db6",
+    "#a96b59",
+    "#e76300",
+    "#b9ac70",
+    "#717581",
+    "#92dadd",
+)
+
+DATA_FIELDS = ("EGamma", "Muon", "MuonEG")
+
+
 def stacked_colors(num: int) -> list[str]:
     """
     Returns a list of colors consistent with the CMS Analysis Guidelines (https://cms-analysis.docs.cern.ch/guidelines/plotting/colors/)
@@ -20,21 +39,28 @@ def stacked_colors(num: int) -> list[str]:
     Returns:
         list[str]: A list of colors, formatted in hexadecimal
     """
-    colors = """
-    #3f90da
-    #ffa90e
-    #bd1f01
-    #94a4a2
-    #832db6
-    #a96b59
-    #e76300
-    #b9ac70
-    #717581
-    #92dadd 	""".split()
-    return colors[0:num]
-
-
-def plot_thing(histogram: hist.Hist, title: str, units: str):
+    return list(STACKED_COLORS[0:num])
+
+
+def stacked_datasets(
+    datasets: hist.axis.StrCategory,
+) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """
+    Splits the datasets of a histogram into those to stack and their colors
+
+    Args:
+        datasets (hist.axis.StrCategory): A histogram's dataset axis, or any iterable of dataset names
+
+    Returns:
+        tuple[tuple[str, ...], tuple[str, ...]]: The datasets to stack, and the colors to use for each
+    """
+    stacked_keys = tuple(
+        key for key in datasets if key not in DATA_FIELDS and key != "TTTT"
+    )
+    return stacked_keys, STACKED_COLORS[0 : len(stacked_keys)]
+
+
+def plot_thing(histogram: hist.Hist, title: str, units: str, sort: bool = False):
     """
     A convenience function used to generate a bar graph and Data/MC agreement plot, as well as plot signal
 
@@ -42,29 +68,35 @@ def plot_thing(histogram: hist.Hist, title: str, units: str):
         histogram (hist.Hist): The histogram object to plot. This should have two axis: a dataset axis and an axis to plot
         title (str): The title of the appropriate histogram
         units (str): The units of bin width, for use when labeling axis
+        sort (bool, default False): Stack datasets by descending yield. Off by default, as the order (and so colors) would vary between plots
 
     Returns:
         plt.Figure: A figure which may be saved locally
     """
-    data_fields = ["EGamma", "Muon", "MuonEG"]
-    mc_keys = [field for field in histogram.axes[0] if field not in data_fields]
+    data = histogram[list(DATA_FIELDS), :][sum, :]
 
-    data = histogram[data_fields, :][sum, :]
-
-    stacked_keys = [key for key in mc_keys if key != "TTTT"]
+    stacked_keys, colors = stacked_datasets(histogram.axes[0])
     stacked_histos = [histogram[key, :] for key in stacked_keys]
 
-    # DISABLED: This can vary between plots!
-    # pairs = zip(stacked_keys, stacked_histos)
-    # pairs_sorted = sorted(pairs, key=lambda pair: pair[1].sum().value, reverse=True)
-    # stacked_keys, stacked_histos = list(zip(*pairs_sorted))
+    if sort:
+        sums = np.fromiter(
+            (histo.sum().value for histo in stacked_histos),
+            dtype=np.float64,
+            count=len(stacked_histos),
+        )
+        # Stable, so equal yields keep their dataset order. Colors follow their dataset
+        order = np.argsort(-sums, kind="stable")
+        stacked_keys = [stacked_keys[i] for i in order]
+        stacked_histos = [stacked_histos[i] for i in order]
+        # The palette only has 10 colors, so it is cycled for further datasets rather than indexing past its end
+        colors = [STACKED_COLORS[i % len(STACKED_COLORS)] for i in order]
 
     fig, (ax_main, ax_comparison) = hep.subplots(nrows=2)
     hep.comp.data_model(
         data,
         stacked_components=stacked_histos,
-        stacked_labels=stacked_keys,
-        stacked_colors=stacked_colors(len(stacked_histos)),
+        stacked_labels=list(stacked_keys),
+        stacked_colors=list(colors),
         fig=fig,
         ax_comparison=ax_comparison,
         ax_main=ax_main,
@@ -86,6 +118,10 @@ def plot_thing(histogram: hist.Hist, title: str, units: str):
     return fig
 
 
+# Shared by all histograms - each hist.Hist keeps its own copy of its axes, so growth doesn't leak between them
+DATASET_AXIS = hist.axis.StrCategory([], name="dataset", label="Process", growth=True)
+
+
 def create_single_axis_histogram(axis: hist.axis.AxesMixin) -> hist.Hist:
     """
     Creates a hist.Hist with a dataset axis and weights, alongside a given axis
@@ -96,12 +132,8 @@ def create_single_axis_histogram(axis: hist.axis.AxesMixin) -> hist.Hist:
     Returns:
         hist.Hist: A histogram with the given axis as well as a dataset axis and weight storage
     """
-    dataset_axis = hist.axis.StrCategory(
-        [], name="dataset", label="Process", growth=True
-    )
-
     return hist.Hist(
-        dataset_axis,
+        DATASET_AXIS,
         axis,
         storage=hist.storage.Weight(),
     )
@@ -257,9 +289,42 @@ class EtaToPlot(ThingToPlot):
         fig.savefig(output_file)
 
 
+@numba.vectorize(
+    [
+        "float32(float32, float32, float32, float32, float32, float32)",
+        "float64(float64, float64, float64, float64, float64, float64)",
+    ],
+    # Compiled code is cached on disk, so only the first import compiles
+    cache=True,
+)
+def dilepton_mass(
+    pt_1: float, eta_1: float, phi_1: float, pt_2: float, eta_2: float, phi_2: float
+) -> float:
+    """
+    Computes the invariant mass of two massless objects in a single pass, without intermediate arrays
+
+    This is a ufunc, and so may be called directly on awkward arrays
+
+    Args:
+        pt_1 (float): The pT of the first object
+        eta_1 (float): The eta of the first object
+        phi_1 (float): The phi of the first object
+        pt_2 (float): The pT of the second object
+        eta_2 (float): The eta of the second object
+        phi_2 (float): The phi of the second object
+
+    Returns:
+        float: The invariant mass of both objects
+    """
+    # cosh(x) - cos(y) = 2 * (sinh(x/2)^2 + sin(y/2)^2), which avoids cancellation for collimated pairs
+    sinh_deta = np.sinh(0.5 * (eta_1 - eta_2))
+    sin_dphi = np.sin(0.5 * (phi_1 - phi_2))
+    return 2 * np.sqrt(pt_1 * pt_2 * (sinh_deta * sinh_deta + sin_dphi * sin_dphi))
+
+
 class DileptonMassToPlot(ThingToPlot):
     """
-    Plot the dilepton mass of two leptons. The order doesn't matter due to the cos and cosh functions being even.
+    Plot the dilepton mass of two leptons. The order doesn't matter due to the squared sin and sinh functions being even.
 
     No check is done to ensure the given lepton is present. Non-present leptons will result in a crash.
     """
@@ -306,11 +371,8 @@ class DileptonMassToPlot(ThingToPlot):
     ) -> hist.Hist:
         obj_1 = events[self.first_lepton_name][:, self.first_lepton_index]
         obj_2 = events[self.second_lepton_name][:, self.second_lepton_index]
-        mass = np.sqrt(
-            2
-            * obj_1.pt
-            * obj_2.pt
-            * (np.cosh(obj_1.eta - obj_2.eta) - np.cos(obj_1.phi - obj_2.phi))
+        mass = dilepton_mass(
+            obj_1.pt, obj_1.eta, obj_1.phi, obj_2.pt, obj_2.eta, obj_2.phi
         )
 
         histogram.fill(
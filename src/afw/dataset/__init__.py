@@ -1,6 +1,7 @@
 from . import cached, definitions, local, skimmed
 
 import logging
+from collections import Counter
 
 
 def print_summary(
@@ -18,13 +19,12 @@ def print_summary(
     logger.info("Printing Dataset")
     # Display in a table to look nice
 
-    by_name = {}
+    by_name = Counter()
     for dataset_name, dataset in fileset.items():
         key = dataset["metadata"]["shortName"] if use_short_name else dataset_name
-        num = len(dataset["files"])
-        by_name[key] = by_name.get(key, 0) + num
+        by_name[key] += len(dataset["files"])
 
-    maxlen = max([len(name) for name in by_name.keys()])
+    maxlen = max(map(len, by_name), default=0)
     if maxlen < len("Category"):
         maxlen = len("Category")
 
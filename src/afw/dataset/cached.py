@@ -8,6 +8,7 @@ Utilities to interface with tools only available on select platforms (eg. dasgoc
 # Retrieved 2025-12-03, License - CC BY-SA 3.0
 
 import atexit
+import functools
 import io
 import json
 import logging
@@ -15,25 +16,20 @@ import os
 import pickle
 import re
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import yaml
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 logger = logging.getLogger("Local Cache")
 
 # For xsecdb
-cookie_path = os.path.abspath("cookie.txt")
 base_url = "https://xsecdb-xsdb-official.app.cern.ch"
-
+nanoaod_version = re.compile(r"NanoAODv\d+")
 override_file = os.path.join(os.curdir, "xsecdb-overrides.yaml")
-overrides = {}
-if os.path.exists(override_file):
-    logger.debug(f"Loading overrides file {override_file}")
-    with open(override_file, "r") as file:
-        overrides = yaml.safe_load(file)
-
-    if not isinstance(overrides, dict):
-        logger.critical("Overrides is not a valid python dict object! Replacing...")
-        overrides = {}
 
 # Curl client
 c = None
@@ -44,7 +40,9 @@ client = None
 
 def persist_to_file(file_name: str):
     """
-    A decorator used for caching function results. Decorated functions will persist their results to pickle files (and yaml files for inspection) on program exit.
+    A decorator used for caching function results. Decorated functions will persist their results to pickle files on program exit.
+
+    If the AFW_CACHE_YAML environment variable is set, results are also written to yaml files for inspection.
 
     Args:
         file_name (str): The base name (without extension) to save results to
@@ -59,6 +57,8 @@ def persist_to_file(file_name: str):
         with open(pickle_file, "rb") as file:
             cache = pickle.load(file)
     elif os.path.exists(yaml_file):
+        import yaml
+
         with open(yaml_file, "r") as file:
             # Not safe-load
             # If someone's modified your yaml files, this may execute arbitrary code
@@ -71,22 +71,61 @@ def persist_to_file(file_name: str):
     if "_changed" in cache:
         del cache["_changed"]
 
+    lock = threading.Lock()
+
     def save_cache():
-        if not cache.get("_changed", False):
-            return
-        with open(yaml_file, "w") as file:
-            yaml.dump(cache, file)
-        with open(pickle_file, "wb") as file:
-            pickle.dump(cache, file)
+        with lock:
+            if not cache.get("_changed", False):
+                return
+
+            # Write to temporary files first so an interrupted save can't corrupt the cache
+            if os.environ.get("AFW_CACHE_YAML"):
+                import yaml
+
+                with open(yaml_file + ".tmp", "w") as file:
+                    yaml.dump(cache, file)
+                os.replace(yaml_file + ".tmp", yaml_file)
+            with open(pickle_file + ".tmp", "wb") as file:
+                pickle.dump(cache, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(pickle_file + ".tmp", pickle_file)
 
     atexit.register(save_cache)
 
+    def make_key(args: tuple, kwargs: dict):
+        # Single-argument calls keep their plain key, matching existing caches
+        if len(args) == 1 and not kwargs:
+            return args[0]
+        return (args, tuple(sorted(kwargs.items())))
+
     def decorator(func):
-        def new_func(param):
-            if param not in cache:
-                cache[param] = func(param)
+        @functools.wraps(func)
+        def new_func(*args, **kwargs):
+            key = make_key(args, kwargs)
+            with lock:
+                if key in cache:
+                    return cache[key]
+
+            # Call outside of the lock, so slow queries may run concurrently
+            value = func(*args, **kwargs)
+            with lock:
+                cache[key] = value
                 cache["_changed"] = True
-            return cache[param]
+            return value
+
+        def has(*args, **kwargs) -> bool:
+            key = make_key(args, kwargs)
+            with lock:
+                return key in cache
+
+        def store(value, *args, **kwargs) -> None:
+            key = make_key(args, kwargs)
+            with lock:
+                cache[key] = value
+                cache["_changed"] = True
+
+        # Allow results fetched elsewhere (eg. in bulk) to be checked and stored
+        new_func.has = has
+        new_func.store = store
 
         return new_func
 
@@ -114,44 +153,69 @@ def run_dasgoclient(query: str) -> dict:
     )
 
     # logger.debug(f"Got entry {response}")
-    return json.loads(response)
+    return json_loads(response)
 
 
-# XSecDB
-# Only save authenticated CURLs
-@persist_to_file("xsecdb")
-def do_request(das_key: str) -> dict:
+def run_dasgoclient_many(queries: list[str]) -> None:
     """
-    Query xsecdb for a given DAS key and returns the json result
+    Run dasgoclient for several queries, running uncached queries concurrently
 
-    This requires a cookie.txt file and persists to disk
+    Results are only added to the run_dasgoclient cache, from which they may then be read
 
     Args:
-        das_key (str): The DAS key to query xsecdb for
+        queries (list[str]): The DAS queries to run
+    """
+    uncached = [query for query in set(queries) if not run_dasgoclient.has(query)]
+    if len(uncached) == 0:
+        return
+
+    logger.debug(f"Running dasgoclient for {len(uncached)} queries")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(run_dasgoclient, uncached))
+
+
+# XSecDB
+def create_curl():
+    """
+    Create a curl handle for querying xsecdb, authenticated with cookie.txt
 
     Returns:
-        dict: The result from xsecdb
+        pycurl.Curl: A curl handle set up to search xsecdb
     """
     # Only import if needed
     import pycurl
 
+    cookie_path = os.path.abspath("cookie.txt")
     if not os.path.exists(cookie_path):
         raise ValueError(
             "Cookie does not exist! Please create a cookies.txt file using a web extension (as CLI tools do not support 2fa)"
         )
 
-    global c
-    if c is None:
-        c = pycurl.Curl()
-        c.setopt(pycurl.FOLLOWLOCATION, 1)
-        # c.setopt(pycurl.COOKIEJAR, cookie_path)
-        c.setopt(
-            pycurl.HTTPHEADER,
-            ["Content-Type: application/json", "Accept: application/json"],
-        )
-        c.setopt(pycurl.COOKIEFILE, cookie_path)
-        c.setopt(pycurl.VERBOSE, 0)
-        c.setopt(pycurl.URL, f"{base_url}/api/search")
+    curl = pycurl.Curl()
+    curl.setopt(pycurl.FOLLOWLOCATION, 1)
+    # curl.setopt(pycurl.COOKIEJAR, cookie_path)
+    curl.setopt(
+        pycurl.HTTPHEADER,
+        ["Content-Type: application/json", "Accept: application/json"],
+    )
+    curl.setopt(pycurl.COOKIEFILE, cookie_path)
+    curl.setopt(pycurl.VERBOSE, 0)
+    curl.setopt(pycurl.URL, f"{base_url}/api/search")
+    return curl
+
+
+def prepare_request(curl, das_key: str) -> io.BytesIO:
+    """
+    Set up a curl handle to search xsecdb for a given DAS key
+
+    Args:
+        curl (pycurl.Curl): A handle created by create_curl
+        das_key (str): The DAS key to query xsecdb for
+
+    Returns:
+        io.BytesIO: The buffer the response will be written to
+    """
+    import pycurl
 
     request = {
         "search": {"DAS": das_key},
@@ -161,9 +225,56 @@ def do_request(das_key: str) -> dict:
     body = json.dumps(request)
     buffer = io.BytesIO()
 
-    c.setopt(pycurl.WRITEDATA, buffer)
-    c.setopt(pycurl.POST, 1)
-    c.setopt(pycurl.POSTFIELDS, body)
+    curl.setopt(pycurl.WRITEDATA, buffer)
+    curl.setopt(pycurl.POST, 1)
+    curl.setopt(pycurl.POSTFIELDS, body)
+    return buffer
+
+
+@functools.lru_cache(maxsize=1)
+def get_overrides() -> dict[str, float]:
+    """
+    Load cross-section overrides from xsecdb-overrides.yaml, if it exists
+
+    This is loaded on first use, so importing this module stays cheap
+
+    Returns:
+        dict[str, float]: A map from DAS key to cross-section
+    """
+    if not os.path.exists(override_file):
+        return {}
+
+    import yaml
+
+    logger.debug(f"Loading overrides file {override_file}")
+    with open(override_file, "r") as file:
+        overrides = yaml.safe_load(file)
+
+    if not isinstance(overrides, dict):
+        logger.critical("Overrides is not a valid python dict object! Replacing...")
+        overrides = {}
+    return overrides
+
+
+# Only save authenticated CURLs
+@persist_to_file("xsecdb")
+def do_request(das_key: str) -> dict:
+    """
+    Query xsecdb for a given DAS key and returns the json result
+
+    This requires a cookie.txt file and persists to disk
+
+    Args:
+        das_key (str): The DAS key to query xsecdb for
+
+    Returns:
+        dict: The result from xsecdb
+    """
+    global c
+    if c is None:
+        c = create_curl()
+
+    buffer = prepare_request(c, das_key)
     c.perform()
 
     response = json.loads(buffer.getvalue())
@@ -171,6 +282,84 @@ def do_request(das_key: str) -> dict:
     return response, response_code
 
 
+def do_requests(
+    das_keys: list[str], max_connections: int = 8
+) -> list[tuple[dict, int]]:
+    """
+    Query xsecdb for several DAS keys at once and returns the json results
+
+    This requires a cookie.txt file. Results are not cached - see get_cross_sections
+
+    Args:
+        das_keys (list[str]): The DAS keys to query xsecdb for
+        max_connections (int, default 8): The maximum number of concurrent connections to xsecdb
+
+    Returns:
+        list[tuple[dict, int]]: The result and response code from xsecdb for each key
+
+    Raises:
+        pycurl.error: If any request fails to transfer
+    """
+    # Only import if needed
+    import pycurl
+
+    multi = pycurl.CurlMulti()
+    # Limit concurrent connections to xsecdb, queueing the rest
+    multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, max_connections)
+
+    requests = []
+    keys = {}
+    try:
+        for das_key in das_keys:
+            curl = create_curl()
+            buffer = prepare_request(curl, das_key)
+            multi.add_handle(curl)
+            keys[curl] = das_key
+            requests += [(curl, buffer)]
+
+        # Run all requests concurrently, collecting any failed transfers
+        errors = []
+        active = len(requests)
+        while active:
+            _, active = multi.perform()
+            while True:
+                queued, _, failed = multi.info_read()
+                errors += [(keys[curl], message) for curl, _, message in failed]
+                if queued == 0:
+                    break
+            if active:
+                multi.select(1.0)
+
+        if len(errors) > 0:
+            das_key, message = errors[0]
+            raise pycurl.error(
+                f"{len(errors)} xsecdb requests failed, eg. for {das_key}: {message}"
+            )
+
+        return [
+            (json.loads(buffer.getvalue()), curl.getinfo(pycurl.RESPONSE_CODE))
+            for curl, buffer in requests
+        ]
+    finally:
+        for curl in keys:
+            multi.remove_handle(curl)
+            curl.close()
+        multi.close()
+
+
+def get_search_key(fileset: str) -> str:
+    """
+    Find the xsecdb search key for a fileset, matching eg. /TTZH_TuneCP5_13p6TeV_madgraph-pythia8/Run3Summer22EE
+
+    Args:
+        fileset (str): The DAS key of the fileset
+
+    Returns:
+        str: The key to query xsecdb with
+    """
+    return nanoaod_version.split(fileset)[0]
+
+
 def get_cross_section(fileset: str) -> float:
     """
     Try and find the cross-section for a given fileset
@@ -184,14 +373,14 @@ def get_cross_section(fileset: str) -> float:
         float: The returned cross-section
     """
     # Check first!
+    overrides = get_overrides()
     if fileset in overrides:
         logger.debug(f"Using override for fileset {fileset}")
         return overrides[fileset]
 
     logger.debug(f"Getting cross-section for fileset {fileset}")
 
-    # Search for part matching /TTZH_TuneCP5_13p6TeV_madgraph-pythia8/Run3Summer22EE
-    search_key = re.split(r"NanoAODv\d+", fileset)[0]
+    search_key = get_search_key(fileset)
     logger.debug(f"Querying xsecdb with search key {search_key}")
     result, response_code = do_request(search_key)
 
@@ -220,6 +409,32 @@ def get_cross_section(fileset: str) -> float:
     return float(xsecs[0])
 
 
+def get_cross_sections(filesets: list[str]) -> dict[str, float]:
+    """
+    Try and find the cross-sections for several filesets
+
+    Uncached xsecdb queries are run concurrently before interpreting results as in get_cross_section
+
+    Args:
+        filesets (list[str]): The DAS keys of the filesets
+
+    Returns:
+        dict[str, float]: A map from each fileset to its cross-section
+    """
+    overrides = get_overrides()
+    search_keys = {
+        get_search_key(fileset) for fileset in filesets if fileset not in overrides
+    }
+    search_keys = [key for key in search_keys if not do_request.has(key)]
+
+    if len(search_keys) > 0:
+        logger.debug(f"Querying xsecdb for {len(search_keys)} search keys")
+        for search_key, response in zip(search_keys, do_requests(search_keys)):
+            do_request.store(response, search_key)
+
+    return {fileset: get_cross_section(fileset) for fileset in filesets}
+
+
 # Get xsec from dataset
 @persist_to_file("rucio")
 def get_all_matching(query: str) -> list[dict]:
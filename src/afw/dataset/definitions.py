@@ -2,44 +2,63 @@
 Utilities for loading definitions from dataset yaml files
 """
 
+import copy
+import functools
 import logging
-import yaml
+import os
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 logger = logging.getLogger("Dataset Definitions")
 
 
 # Convert MC/Data to a proper dataset definition
-def convert_section(section: list, is_data: bool):
+def convert_sections(sections: list[tuple[list, bool]]) -> dict:
     """
-    Loads a monte-carlo or data definition section
+    Loads several monte-carlo or data definition sections into a single map
 
     Args:
-        section (list): A list of objects, each of which has a shortName and datasets key. Additional keys will persist as metadata.
-        is_data (bool): The value to apply to the isData metadata key
+        sections (list[tuple[list, bool]]): Pairs of sections and the value to apply to their isData metadata key. Each section is a list of objects, each of which has a shortName and datasets key. Additional keys will persist as metadata.
 
     Returns:
         dict[str, dict]: A map from DAS key pattern to the associated metadata object
     """
     result = {}
-    for entry in section:
-        shortName = entry["shortName"]
-        if "datasets" not in entry:
-            logger.critical(
-                f"No datasets available for section with shortName {shortName}"
-            )
-            continue
+    for section, is_data in sections:
+        for entry in section:
+            shortName = entry["shortName"]
+            if "datasets" not in entry:
+                logger.critical(
+                    f"No datasets available for section with shortName {shortName}"
+                )
+                continue
+
+            # Copy metadata without datasets, and add data tag
+            metadata = {key: val for key, val in entry.items() if key != "datasets"}
+            metadata["isData"] = is_data
+
+            # Shared between all datasets in the entry
+            for dataset in entry["datasets"]:
+                result[dataset] = metadata
 
-        # Copy metadata, remove datasets
-        metadata = entry.copy()
-        del metadata["datasets"]
+    return result
 
-        # Add data tag
-        metadata["isData"] = is_data
 
-        for dataset in entry["datasets"]:
-            result[dataset] = metadata
+def convert_section(section: list, is_data: bool) -> dict:
+    """
+    Loads a monte-carlo or data definition section
 
-    return result
+    Args:
+        section (list): A list of objects, each of which has a shortName and datasets key. Additional keys will persist as metadata.
+        is_data (bool): The value to apply to the isData metadata key
+
+    Returns:
+        dict[str, dict]: A map from DAS key pattern to the associated metadata object
+    """
+    return convert_sections([(section, is_data)])
 
 
 # Convert a full year defined
@@ -54,27 +73,75 @@ def convert_year(year: dict):
     Returns
         dict: A mapping of DAS key patterns to metadata
     """
-    return convert_section(year["data"], True) | convert_section(
-        year["monteCarlo"], False
-    )
+    return convert_sections([(year["data"], True), (year["monteCarlo"], False)])
+
+
+def iter_years(file, only_year: str | None = None):
+    """
+    Loads each year from a definitions file. The whole document is composed into nodes up front, but each year is only constructed into python objects as it is consumed
+
+    Args:
+        file (file): An open definitions file
+        only_year (str | None, default None): If set, only this year is constructed. Years are compared as strings, so eg. "2023" matches a 2023 key
 
+    Yields:
+        tuple[str, dict]: Each year and its raw definition
 
-def build_definitions(filename: str) -> dict:
+    Raises:
+        KeyError: If only_year is set but not present in the file
+    """
+    loader = SafeLoader(file)
+    try:
+        root = loader.get_single_node()
+        pairs = root.value if root is not None else []
+        for key_node, value_node in pairs:
+            year = loader.construct_object(key_node)
+            if only_year is not None and str(year) != str(only_year):
+                continue
+
+            yield year, loader.construct_object(value_node, deep=True)
+            if only_year is not None:
+                return
+
+        if only_year is not None:
+            raise KeyError(f"Year {only_year} not found in definitions")
+    finally:
+        loader.dispose()
+
+
+@functools.lru_cache(maxsize=16)
+def load_definitions(filename: str, mtime: float, only_year: str | None = None) -> dict:
+    """
+    Loads and builds dataset definitions once per file and modification time
+
+    Args:
+        filename (str): The absolute path to a definitions file
+        mtime (float): The modification time of the file, used to reload it when changed
+        only_year (str | None, default None): If set, only this year is built. Raises KeyError if it is not present
+
+    Returns:
+        dict: A mapping of era to per-year definitions. This is shared between calls and must not be modified
+    """
+    # Open file, converting each year as it is read
+    with open(filename, "r") as file:
+        return {year: convert_year(val) for year, val in iter_years(file, only_year)}
+
+
+def build_definitions(filename: str, only_year: str | None = None) -> dict:
     """
     Loads and builds custom dataset definitions from a given file
 
+    Parsed files are cached until they are modified
+
     Args:
         filename (str): Any file that can be opened with open()
+        only_year (str | None, default None): If set, only this year is built. Other years are not constructed
 
     Returns:
         dict: A mapping of era to per-year definitions, each of which is a map from DAS key patterns to metadata
     """
-    # Open file
-    with open(filename, "r") as file:
-        result = yaml.safe_load(file)
+    filename = os.path.abspath(filename)
+    result = load_definitions(filename, os.path.getmtime(filename), only_year)
 
-    # Convert each year
-    for year, val in result.items():
-        result[year] = convert_year(val)
-
-    return result
+    # Callers may modify their copy freely. deepcopy keeps metadata shared between datasets of the same entry
+    return copy.deepcopy(result)
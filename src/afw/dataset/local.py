@@ -2,6 +2,7 @@
 Utilities for building datasets from patterns and applying metadata (eg. cross-section)
 """
 
+import functools
 import logging
 
 from . import cached
@@ -9,7 +10,23 @@ from . import cached
 # Load Cache
 logger = logging.getLogger("Local Dataset Builder")
 
-veto = None
+veto_file = "veto-files.txt"
+
+
+@functools.lru_cache(maxsize=1)
+def load_veto() -> frozenset[str]:
+    """
+    Loads the set of vetoed files from veto-files.txt, if it exists
+
+    Returns:
+        frozenset[str]: The paths of all vetoed files
+    """
+    try:
+        with open(veto_file, "r") as file:
+            return frozenset(line.strip() for line in file)
+    except FileNotFoundError:
+        logger.debug(f"No veto file found at {veto_file}")
+        return frozenset()
 
 
 def is_vetoed(file: str) -> bool:
@@ -22,72 +39,108 @@ def is_vetoed(file: str) -> bool:
     Returns:
         bool: Whether the file is vetoed or not
     """
-    # Check for presence
-    global veto
-    if veto is None:
-        with open("veto-files.txt", "r") as file:
-            veto = [line.strip() for line in file]
+    return file in load_veto()
+
+
+@functools.lru_cache(maxsize=4096)
+def dasgoclient_file_list(das_key: str) -> tuple[tuple[str, int | None], ...]:
+    """
+    Lists the files in a fileset using dasgoclient, reduced to names and event counts
+
+    Results are cached in memory on top of the on-disk dasgoclient cache, avoiding re-parsing responses
+
+    Args:
+        das_key (str): The DAS key of the fileset
+
+    Returns:
+        tuple[tuple[str, int | None], ...]: The name and number of events (None if missing) of each file
+    """
+    response = cached.run_dasgoclient(f"file dataset={das_key}")
+
+    files = []
+    for entry in response:
+        if len(entry["file"]) != 1:
+            raise ValueError(f"More than one file for file object: {entry}")
+        file = entry["file"][0]
+        files += [(file["name"], file.get("nevents"))]
+
+    return tuple(files)
+
+
+def parse_files(
+    file_list: tuple[tuple[str, int | None], ...], prefix: str
+) -> tuple[dict[str, str], int]:
+    """
+    Collects the usable files from a fileset, skipping vetoed and empty files
+
+    Args:
+        file_list (tuple[tuple[str, int | None], ...]): The files of a fileset, as returned by dasgoclient_file_list
+        prefix (str): A prefix for each file name, such as an xcache redirector
+
+    Returns:
+        tuple[dict[str, str], int]: A map from each file to its tree name, and the total number of events
+    """
+    veto = load_veto()
+    nevents = 0
+    files = {}
+    for name, file_nevents in file_list:
+        if name in veto:
+            logger.critical(f"Skipping file due to entry in veto list: {name}")
+            continue
 
-    return file in veto
+        if file_nevents is None:
+            logger.critical(f"File is missing nevents: {name}")
+            continue
+
+        if file_nevents == 0:
+            logger.warning(f"Skipping file due to 0 events: {name}")
+            continue
+
+        # Save file, add nevents
+        files[prefix + name] = "Events"
+        nevents += file_nevents
+
+    return files, nevents
 
 
 def build_datasets(defs, xcache_host: str = None):
     # Actually load from Rucio
-    result = {}
     # Convert to filesets (aka das keys)
+    filesets = {}
     for query, metadata in defs.items():
         for das_key in cached.get_all_matching(query):
-            result[das_key] = {"metadata": metadata.copy()}
-
-    # Do magic with dasgoclient
-    for key, val in result.items():
-        response = cached.run_dasgoclient(f"file dataset={key}")
-
-        nevents = 0
-        files = {}
-        # Parse dasgoclient results
-        for entry in response:
-            if len(entry["file"]) != 1:
-                raise ValueError(f"More than one file for file object: {entry}")
-            file = entry["file"][0]
-
-            name = file["name"]
-            if is_vetoed(name):
-                logger.critical(f"Skipping file due to entry in veto list: {file}")
-                continue
-
-            if "nevents" not in file:
-                logger.critical(f"File is missing nevents: {file}")
-                continue
-
-            if file["nevents"] == 0:
-                logger.warning(f"Skipping file due to 0 events: {file['name']}")
-                continue
-
-            # Save file, add nevents
-            files[xcache_host + file["name"]] = "Events"
-            nevents += file["nevents"]
-
-        val["metadata"]["nevents"] = nevents
-        val["files"] = files
-
-    # Add xsecs
-    for key, val in result.items():
-        if val["metadata"].get("isData", False):
+            filesets[das_key] = metadata
+
+    # Do magic with dasgoclient, fetching uncached filesets at once to fill the cache
+    prefix = xcache_host or ""
+    cached.run_dasgoclient_many([f"file dataset={key}" for key in filesets])
+
+    # Build each fileset in a single pass, skipping empty ones before they're added
+    result = {}
+    needs_xsec = []
+    for key, metadata in filesets.items():
+        files, nevents = parse_files(dasgoclient_file_list(key), prefix)
+        if len(files) == 0:
+            logger.critical(
+                f"Fileset {key} (short name {metadata['shortName']}) has zero files!"
+            )
             continue
-        if "xsec" in val["metadata"]:
+
+        # Metadata is shared between datasets of the same entry, so copy before adding to it
+        metadata = dict(metadata, nevents=nevents)
+        result[key] = {"metadata": metadata, "files": files}
+
+        if metadata.get("isData", False):
+            continue
+        if "xsec" in metadata:
             logger.debug(
                 f"Skipping xsecdb for fileset as already present in definition: {key}"
             )
             continue
-        val["metadata"]["xsec"] = cached.get_cross_section(key)
+        needs_xsec += [key]
 
-    # Check for empty
-    for fileset_name, fileset in list(result.items()):
-        if len(fileset["files"]) == 0:
-            logger.critical(
-                f"Fileset {fileset_name} (short name {fileset['metadata']['shortName']}) has zero files!"
-            )
-            del result[fileset_name]
+    # Add xsecs, querying xsecdb for all filesets at once
+    for key, xsec in cached.get_cross_sections(needs_xsec).items():
+        result[key]["metadata"]["xsec"] = xsec
 
     return result
@@ -2,15 +2,21 @@
 Utilities for skimmed datasets
 """
 
+import functools
+import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger("Skimmed Dataset Builder")
 
+manifest_name = "manifest.json"
 
+
+@functools.lru_cache(maxsize=4096)
 def escape_name(dataset: str) -> str:
     """
-    Escapes a dataset's DAS key to a folder path name
+    Escapes a dataset's DAS key to a folder path name. Results are cached, as names are escaped when skimming, merging and loading skims
     """
     safe_name = dataset.replace(os.path.sep, "_")
     if safe_name.startswith("_"):
@@ -18,7 +24,68 @@ def escape_name(dataset: str) -> str:
     return safe_name
 
 
-def convert_to_skimmed(dataset: dict, skim_dir: str) -> dict:
+def write_manifest(skim_path: str) -> list[str]:
+    """
+    Records the root files in a skim directory to a manifest, so they can be found later without listing the directory
+
+    Args:
+        skim_path (str): A directory containing skims for a single dataset
+
+    Returns:
+        list[str]: The sorted names of all root files in the directory
+    """
+    with os.scandir(skim_path) as entries:
+        parts = sorted(entry.name for entry in entries if entry.name.endswith(".root"))
+
+    with open(os.path.join(skim_path, manifest_name), "w") as file:
+        json.dump(parts, file)
+
+    return parts
+
+
+def list_parts(skim_path: str) -> list[str]:
+    """
+    Lists the root files in a skim directory, using its manifest if present
+
+    Args:
+        skim_path (str): A directory containing skims for a single dataset
+
+    Returns:
+        list[str]: The sorted names of all root files in the directory
+    """
+    try:
+        with open(os.path.join(skim_path, manifest_name), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        logger.debug(f"No manifest found, listing directory {skim_path}")
+
+    with os.scandir(skim_path) as entries:
+        return sorted(entry.name for entry in entries if entry.name.endswith(".root"))
+
+
+def scan_skims(base_path: str) -> list[str] | None:
+    """
+    Lists the root files in a skim directory
+
+    Args:
+        base_path (str): A directory containing skims for a single dataset
+
+    Returns:
+        list[str] | None: The paths of all root files in the directory, or None if it does not exist
+    """
+    # A single scandir replaces isdir + listdir, and DirEntry.is_file uses the cached file type
+    try:
+        with os.scandir(base_path) as entries:
+            return [
+                os.path.join(base_path, entry.name)
+                for entry in entries
+                if entry.name.endswith(".root") and entry.is_file()
+            ]
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def convert_to_skimmed(dataset: dict, skim_dir: str, parallel: bool = True) -> dict:
     """
     Replaces a dataset's list of files with a set of skimmed files on the local disk
 
@@ -27,6 +94,7 @@ def convert_to_skimmed(dataset: dict, skim_dir: str) -> dict:
     Args:
         dataset (dict): A fully-rendered dataset with files and metadata
         skim_dir (str): A local directory to check for skims in
+        parallel (bool, default True): List skim directories concurrently, which helps on high-latency filesystems
 
     Returns:
         dict: A fully-rendered dataset with skims replacing root files
@@ -39,39 +107,50 @@ def convert_to_skimmed(dataset: dict, skim_dir: str) -> dict:
     if has_merged:
         logger.info("Using merged skim files!")
 
+    safe_names = {dataset_name: escape_name(dataset_name) for dataset_name in dataset}
+
+    if has_merged:
+        listings = [None] * len(safe_names)
+    else:
+        base_paths = [
+            os.path.join(skim_dir, safe_name) for safe_name in safe_names.values()
+        ]
+        if parallel:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                listings = list(executor.map(scan_skims, base_paths))
+        else:
+            listings = list(map(scan_skims, base_paths))
+
+    # Checked once, so debug messages aren't formatted when they'd be discarded
+    debug = logger.isEnabledFor(logging.DEBUG)
+
     # For each dataset
-    for dataset_name, dataset_obj in dataset.items():
-        logging.debug(f"Reading dataset {dataset_name} from disk")
+    for (dataset_name, dataset_obj), files in zip(dataset.items(), listings):
+        if debug:
+            logger.debug(f"Reading dataset {dataset_name} from disk")
 
-        # Escape the name
-        safe_name = escape_name(dataset_name)
+        safe_name = safe_names[dataset_name]
 
         if has_merged:
-            files = [os.path.join(merged_dir, f"{safe_name}.root")]
+            files_dict = {os.path.join(merged_dir, f"{safe_name}.root"): "Events"}
         else:
             base_path = os.path.join(skim_dir, safe_name)
-            if not os.path.isdir(base_path):
+            if files is None:
                 logger.critical(
                     f"Dataset {dataset_name} does not have skims, skipping... (directory does not exist: {base_path})"
                 )
                 continue
 
-            files = [
-                os.path.join(base_path, file)
-                for file in os.listdir(base_path)
-                if file.endswith(".root")
-            ]
             if len(files) == 0:
                 logger.critical(
                     f"Dataset {dataset_name} does not have skims, skipping... (directory has no root files: {base_path})"
                 )
                 continue
 
-        logger.debug(f"Loaded dataset {dataset_name} ({len(files)} files)")
+            files_dict = dict.fromkeys(files, "Events")
 
-        files_dict = {}
-        for file in files:
-            files_dict[file] = "Events"
+        if debug:
+            logger.debug(f"Loaded dataset {dataset_name} ({len(files_dict)} files)")
 
         result[dataset_name] = {
             "files": files_dict,
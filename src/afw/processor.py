@@ -3,7 +3,7 @@ from coffea.analysis_tools import Weights
 
 from .objects import AnalysisConfig
 
-import awkward as ak
+import numpy as np
 
 
 lumi22EE = 26.6717 * 1e3
@@ -15,6 +15,10 @@ class MyProcessor(ProcessorABC):
         self.config = config
 
     def process(self, events):
+        # Looked up once, as events.metadata is a property
+        metadata = events.metadata
+        is_data = metadata.get("isData", False)
+
         # Do definition and preselection if needed
         if not self.skimmed:
             events = self.config.define_objects(events)
@@ -23,29 +27,33 @@ class MyProcessor(ProcessorABC):
         # Do selection
         events = self.config.select_events(events)
 
+        # Nothing to fill - skip augmenting, weighting and filling entirely
+        n_events = len(events)
+        if n_events == 0:
+            return {
+                thing.title: thing.create_histogram()
+                for thing in self.config.get_things_to_plot()
+            }
+
         ### Generate results object
         extra_args = self.config.augment_events(events)
         if extra_args is None:
             extra_args = {}
 
         ## Weights
-        weights = Weights(len(events))
-        if "isData" in events.metadata and events.metadata.get("isData", False):
-            weights.add("nominal", ak.ones_like(events.event))
+        weights = Weights(n_events, storeIndividual=False)
+        if is_data:
+            weights.add("nominal", np.ones(n_events))
         else:
             # weights.add("genWeight", events.genWeight)
-            weights.add(
-                "xsec",
-                ak.ones_like(events.genWeight)
-                * lumi22EE
-                * events.metadata["xsec"]
-                / events.metadata["nevents"],
-            )
+            # The same for every event, so computed once as a scalar
+            xsec_weight = lumi22EE * metadata["xsec"] / metadata["nevents"]
+            weights.add("xsec", np.full(n_events, xsec_weight))
 
         weights = weights.weight()
 
         ## Fill histograms
-        dataset = events.metadata["shortName"]
+        dataset = metadata["shortName"]
 
         result = {}
         for thing in self.config.get_things_to_plot():